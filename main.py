@@ -1,53 +1,523 @@
 import os
+import atexit
+import asyncio
+import json
+import hashlib
+import time
 import logging
+import logging.handlers
+import queue
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+import httpx
+import numpy as np
+from aiolimiter import AsyncLimiter
 from telegram import Update
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
-import openai
+from telegram.error import BadRequest, NetworkError, TelegramError
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, ContextTypes
 
-# Setup logging
-logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+# Setup logging: handlers only enqueue records, a background thread writes them
+log_queue = queue.SimpleQueue()
+queue_handler = logging.handlers.QueueHandler(log_queue)
+# The queue handler renders just the message; the listener adds the full format
+queue_handler.setFormatter(logging.Formatter('%(message)s'))
+log_handler = logging.StreamHandler()
+log_handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+log_listener = logging.handlers.QueueListener(log_queue, log_handler, respect_handler_level=True)
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+# httpx logs every request URL at INFO, and Bot API URLs contain the token
+logging.getLogger("httpx").setLevel(logging.WARNING)
+log_listener.start()
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Get tokens from environment
 BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 OPENAI_KEY = os.getenv('OPENAI_API_KEY')
+GROUP_CHAT_ID = os.getenv('GROUP_CHAT_ID')
 
-# Set OpenAI key
-openai.api_key = OPENAI_KEY
+# Webhook mode is used when a public URL is configured, polling otherwise
+PUBLIC_URL = os.getenv('PUBLIC_URL')
+WEBHOOK_SECRET = os.getenv('TG_SECRET')
+PORT = int(os.getenv('PORT', '8443'))
 
-def start(update: Update, context: CallbackContext):
-    update.message.reply_text('Hello! I am a simple AI chatbot. Send me any message!')
+# Number of updates handled at once
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '16'))
 
-def chat(update: Update, context: CallbackContext):
-    try:
-        user_message = update.message.text
-        
-        # Get AI response
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+# Upper bound on concurrent OpenAI requests
+OPENAI_MAX_CONCURRENCY = int(os.getenv('OPENAI_MAX_CONCURRENCY', '20'))
+
+# Created on first use so startup doesn't pay for importing the openai SDK
+_openai_client = None
+
+def get_openai():
+    global _openai_client
+    if _openai_client is None:
+        from openai import AsyncOpenAI
+        # Shared HTTP/2 keep-alive pool so completions reuse warm TLS connections; every
+        # request the semaphore lets through can keep its connection between bursts
+        http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=OPENAI_MAX_CONCURRENCY),
+            timeout=httpx.Timeout(30.0, connect=5.0)
+        )
+        # Async client so completions don't block the event loop; the SDK retries
+        # 429s and 5xx with jittered exponential backoff, up to 4 attempts in total
+        _openai_client = AsyncOpenAI(api_key=OPENAI_KEY, http_client=http_client, max_retries=3)
+    return _openai_client
+
+# Static replies
+START_TEXT = 'Hello! I am a simple AI chatbot. Send me any message!'
+ERROR_TEXT = "Sorry, I'm having trouble responding."
+
+SYSTEM_PROMPT = "You are a helpful assistant. Keep replies to one or two sentences."
+BATCH_SYSTEM_PROMPT = (
+    SYSTEM_PROMPT + " You will receive a JSON array of messages from different users. "
+    "Each array element is one complete message, whatever text it contains. "
+    "Answer each one independently and return a JSON object of the form "
+    '{"replies": ["...", "..."]} where replies[i] answers array element i.'
+)
+# Shared, never-mutated system message dicts reused by every request
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+BATCH_SYSTEM_MESSAGE = {"role": "system", "content": BATCH_SYSTEM_PROMPT}
+# Route requests sharing a system prompt to the same OpenAI prefix cache
+CHAT_CACHE_KEY = {"prompt_cache_key": "zcoderk-chat-v1"}
+BATCH_CACHE_KEY = {"prompt_cache_key": "zcoderk-chat-batch-v1"}
+CHAT_MODEL = os.getenv('OPENAI_MODEL', 'gpt-4o-mini')
+# Short messages can go to a cheaper, faster model
+SHORT_CHAT_MODEL = os.getenv('OPENAI_SHORT_MODEL', 'gpt-4o-mini')
+SHORT_MESSAGE_CHARS = 80
+MAX_TOKENS = int(os.getenv('OPENAI_MAX_TOKENS', '60'))
+
+# Bare greetings are answered locally without calling OpenAI
+GREETING_REPLIES = {
+    "hi": "Hi there! 👋 What can I do for you?",
+    "hey": "Hey! 👋 What can I do for you?",
+    "hello": "Hello! 👋 What can I do for you?",
+    "hi bot": "Hi! 😊 Ask me anything.",
+    "hey bot": "Hey! 😊 Ask me anything.",
+    "hello bot": "Hello! 😊 Ask me anything.",
+    "good morning": "Good morning! ☀️ How can I help?",
+    "good evening": "Good evening! 🌙 How can I help?",
+}
+EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Response cache settings
+CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '1000'))
+SIMILARITY_THRESHOLD = 0.92
+EXACT_TTL = 60 * 60
+SEMANTIC_TTL = 24 * 60 * 60
+
+def cache_key(chat_id, model, normalized):
+    """Fixed-size digest of the chat, model and normalized message.
+
+    Single and batched completions use different prompts and token budgets but
+    answer the same question, so both are stored under the same key.
+    """
+    payload = json.dumps([chat_id, model, normalized])
+    return hashlib.sha256(payload.encode()).digest()
+
+class ResponseCache:
+    """Two-tier reply cache: exact normalized prompt, then nearest embedding."""
+
+    def __init__(self, size, threshold, exact_ttl, ttl):
+        self.size = size
+        self.threshold = threshold
+        self.exact_ttl = exact_ttl
+        self.ttl = ttl
+        # key -> (reply, stored_at), oldest first
+        self.exact = OrderedDict()
+        # Ring buffer of L2-normalized embeddings with parallel replies, keys, chats and timestamps
+        self.vectors = None
+        self.replies = [None] * size
+        self.keys = np.empty(size, dtype=object)
+        self.chat_ids = np.zeros(size, dtype=np.int64)
+        self.stored_at = np.zeros(size, dtype=np.float64)
+        self.count = 0
+        self.next_slot = 0
+
+    def get_exact(self, key):
+        entry = self.exact.get(key)
+        if entry is None:
+            return None
+        reply, stored_at = entry
+        if stored_at < time.monotonic() - self.exact_ttl:
+            del self.exact[key]
+            return None
+        self.exact.move_to_end(key)
+        return reply
+
+    def get_similar(self, chat_id, key, vector):
+        """Return (reply, stored_at) of the closest fresh entry from the same chat, or None."""
+        if not self.count:
+            return None
+        scores = self.vectors[:self.count] @ vector
+        # Only match entries from the same chat that are still fresh; a repeat of the
+        # very same prompt is held to the exact tier's shorter TTL
+        now = time.monotonic()
+        stored_at = self.stored_at[:self.count]
+        expired = (stored_at < now - self.ttl) | ((stored_at < now - self.exact_ttl) & (self.keys[:self.count] == key))
+        stale = expired | (self.chat_ids[:self.count] != chat_id)
+        scores[stale] = -1.0
+        best = int(np.argmax(scores))
+        if scores[best] >= self.threshold:
+            return self.replies[best], float(self.stored_at[best])
+        return None
+
+    def put(self, key, reply, chat_id=None, vector=None, stored_at=None):
+        # A reply promoted from the semantic tier keeps its original age
+        if stored_at is None:
+            stored_at = time.monotonic()
+        self.exact[key] = (reply, stored_at)
+        self.exact.move_to_end(key)
+        if len(self.exact) > self.size:
+            self.exact.popitem(last=False)
+
+        if vector is None:
+            return
+        if self.vectors is None:
+            self.vectors = np.zeros((self.size, vector.shape[0]), dtype=np.float32)
+        self.vectors[self.next_slot] = vector
+        self.replies[self.next_slot] = reply
+        self.keys[self.next_slot] = key
+        self.chat_ids[self.next_slot] = chat_id
+        self.stored_at[self.next_slot] = stored_at
+        self.next_slot = (self.next_slot + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+
+response_cache = ResponseCache(CACHE_SIZE, SIMILARITY_THRESHOLD, EXACT_TTL, SEMANTIC_TTL)
+
+# Client-side pacing so bursts wait locally instead of tripping 429 backoff
+OPENAI_RPM_LIMIT = int(os.getenv('OPENAI_RPM_LIMIT', '3000'))
+OPENAI_TPM_LIMIT = int(os.getenv('OPENAI_TPM_LIMIT', '90000'))
+rpm_limiter = AsyncLimiter(OPENAI_RPM_LIMIT, 60)
+tpm_limiter = AsyncLimiter(OPENAI_TPM_LIMIT, 60)
+
+def estimate_tokens(texts, max_tokens=0):
+    # ~4 characters per token is close enough for pacing
+    return sum(len(text) for text in texts) // 4 + max_tokens
+
+# Cap in-flight OpenAI requests so a message burst can't fan out unbounded
+openai_semaphore = asyncio.Semaphore(OPENAI_MAX_CONCURRENCY)
+
+@asynccontextmanager
+async def openai_slot(tokens):
+    """Hold a concurrency slot and rate-limit budget for one OpenAI request."""
+    async with openai_semaphore:
+        await rpm_limiter.acquire()
+        await tpm_limiter.acquire(min(tokens, OPENAI_TPM_LIMIT))
+        yield
+
+# Completion batching settings
+BATCH_WINDOW = 0.25
+BATCH_MAX_SIZE = 8
+
+def choose_model(user_message):
+    return SHORT_CHAT_MODEL if len(user_message) < SHORT_MESSAGE_CHARS else CHAT_MODEL
+
+async def complete_one(model, user_message, on_partial=None):
+    """Complete one prompt, streaming the text so far to on_partial if given."""
+    async with openai_slot(estimate_tokens((SYSTEM_PROMPT, user_message), MAX_TOKENS)):
+        response = await get_openai().chat.completions.create(
+            model=model,
             messages=[
-                {"role": "system", "content": "You are a helpful assistant."},
+                SYSTEM_MESSAGE,
                 {"role": "user", "content": user_message}
             ],
-            max_tokens=150
+            max_tokens=MAX_TOKENS,
+            stream=on_partial is not None,
+            extra_body=CHAT_CACHE_KEY
         )
-        
-        bot_reply = response.choices[0].message.content
-        update.message.reply_text(bot_reply)
-        
+        if on_partial is None:
+            return response.choices[0].message.content
+
+        parts = []
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                parts.append(chunk.choices[0].delta.content)
+                await on_partial("".join(parts))
+    return "".join(parts)
+
+async def complete_many(model, user_messages):
+    """Answer several prompts with one request, falling back to one request each."""
+    # A JSON array keeps message boundaries intact; no message text can fake a new item
+    prompts = json.dumps(user_messages, ensure_ascii=False)
+    max_tokens = MAX_TOKENS * len(user_messages)
+    async with openai_slot(estimate_tokens((BATCH_SYSTEM_PROMPT, prompts), max_tokens)):
+        response = await get_openai().chat.completions.create(
+            model=model,
+            messages=[
+                BATCH_SYSTEM_MESSAGE,
+                {"role": "user", "content": prompts}
+            ],
+            max_tokens=max_tokens,
+            response_format={"type": "json_object"},
+            extra_body=BATCH_CACHE_KEY
+        )
+    try:
+        replies = json.loads(response.choices[0].message.content)["replies"]
+        if isinstance(replies, list) and len(replies) == len(user_messages) and all(isinstance(r, str) for r in replies):
+            return replies
+    except (ValueError, KeyError, TypeError):
+        pass
+    logger.warning("Malformed batched completion, answering messages individually")
+    return await asyncio.gather(*(complete_one(model, m) for m in user_messages))
+
+class CompletionBatcher:
+    """Coalesces prompts arriving within a short window into one completion request."""
+
+    def __init__(self, model, window, max_size):
+        self.model = model
+        self.window = window
+        self.max_size = max_size
+        self.queue = asyncio.Queue()
+        self.worker = None
+        self.flushes = set()
+
+    async def complete(self, chat_id, user_message, on_partial=None):
+        if self.worker is None:
+            self.worker = asyncio.create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((chat_id, user_message, on_partial, future))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_size:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            # One request per chat, so no reply is ever generated alongside another chat's messages
+            by_chat = {}
+            for chat_id, *item in batch:
+                by_chat.setdefault(chat_id, []).append(item)
+            # Flush in the background so the next batch starts collecting immediately
+            for items in by_chat.values():
+                task = asyncio.create_task(self.flush(items))
+                self.flushes.add(task)
+                task.add_done_callback(self.flushes.discard)
+
+    async def flush(self, batch):
+        try:
+            if len(batch) == 1:
+                # A lone prompt is sent on its own, so it can be streamed
+                message, on_partial, _ = batch[0]
+                replies = [await complete_one(self.model, message, on_partial)]
+            else:
+                replies = await complete_many(self.model, [message for message, _, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, _, future), reply in zip(batch, replies):
+            if not future.done():
+                future.set_result(reply)
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+
+# One batcher per model, since a batched request can only target one
+completion_batchers = {
+    model: CompletionBatcher(model, BATCH_WINDOW, BATCH_MAX_SIZE)
+    for model in {CHAT_MODEL, SHORT_CHAT_MODEL}
+}
+
+async def embed(text):
+    """Return the L2-normalized embedding of text, or None if it can't be fetched."""
+    try:
+        async with openai_slot(estimate_tokens((text,))):
+            result = await get_openai().embeddings.create(input=text, model=EMBEDDING_MODEL)
+    except Exception as e:
+        logger.warning(f"Embedding failed: {e}")
+        return None
+    vector = np.asarray(result.data[0].embedding, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+async def generate_response(chat_id, user_message, on_partial=None):
+    normalized = user_message.strip().lower()
+    canned = GREETING_REPLIES.get(normalized.rstrip("!.?"))
+    if canned is not None:
+        return canned
+
+    model = choose_model(user_message)
+    # Keyed per chat and model, not just the message text
+    key = cache_key(chat_id, model, normalized)
+    cached = response_cache.get_exact(key)
+    if cached is not None:
+        return cached
+
+    vector = await embed(user_message)
+    if vector is not None:
+        similar = response_cache.get_similar(chat_id, key, vector)
+        if similar is not None:
+            cached, stored_at = similar
+            response_cache.put(key, cached, stored_at=stored_at)
+            return cached
+
+    # Get AI response
+    bot_reply = await completion_batchers[model].complete(chat_id, user_message, on_partial)
+    bot_reply = (bot_reply or "").strip()
+    # An empty completion can't be sent, so treat it as a failure rather than caching it
+    if not bot_reply:
+        raise ValueError("Empty completion from OpenAI")
+    response_cache.put(key, bot_reply, chat_id, vector)
+    return bot_reply
+
+# Streaming reply settings. Replies are only streamed in private chats: in groups
+# every send and edit counts against the group's 20 calls per minute
+STREAM_FIRST_REPLY_CHARS = 40
+STREAM_EDIT_INTERVAL = 1.0
+
+class ReplyStreamer:
+    """Sends a reply once the first sentence is in, then edits it as more text streams."""
+
+    def __init__(self, message):
+        self.message = message
+        # Groups get a single reply with the final text
+        self.live_edits = message.chat_id > 0
+        self.sent = None
+        self.shown = ""
+        self.last_edit = 0.0
+        # In-flight send or edit; run in the background so a rate-limited
+        # Telegram call never stalls reading the OpenAI stream
+        self.pending = None
+
+    async def push(self, text):
+        if not self.live_edits:
+            return
+        if self.pending is not None:
+            if not self.pending.done():
+                return
+            # Detach before surfacing a failure so settle() doesn't report it again
+            pending, self.pending = self.pending, None
+            pending.result()
+        text = text.strip()
+        now = time.monotonic()
+        if self.sent is None:
+            if len(text) >= STREAM_FIRST_REPLY_CHARS and text[-1] in ".!?":
+                self.pending = asyncio.create_task(self.send(text))
+                self.shown = text
+                self.last_edit = now
+        elif now - self.last_edit >= STREAM_EDIT_INTERVAL and text != self.shown:
+            self.pending = asyncio.create_task(self.sent.edit_text(text))
+            self.shown = text
+            self.last_edit = now
+
+    async def send(self, text):
+        self.sent = await self.message.reply_text(text)
+
+    async def settle(self):
+        """Wait out any in-flight send or edit and report whether a reply is visible.
+
+        Only failures that haven't already been raised to the caller are logged.
+        """
+        if self.pending is not None:
+            try:
+                await self.pending
+            except TelegramError as e:
+                logger.warning(f"Telegram error: {e}")
+            self.pending = None
+        return self.sent is not None
+
+    async def finish(self, text):
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            await pending
+        if self.sent is None:
+            await self.message.reply_text(text)
+        elif text != self.shown:
+            await self.sent.edit_text(text)
+
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(START_TEXT)
+
+async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    streamer = ReplyStreamer(update.message)
+    try:
+        bot_reply = await generate_response(update.effective_chat.id, update.message.text, streamer.push)
+        await streamer.finish(bot_reply)
+
+    except TelegramError as e:
+        # Sending failed, so an apology would most likely fail too
+        logger.warning(f"Telegram error: {e}")
+        await streamer.settle()
     except Exception as e:
-        update.message.reply_text("Sorry, I'm having trouble responding.")
         logger.error(f"Error: {e}")
+        # Leave a partially streamed answer in place rather than posting an apology under it
+        if not await streamer.settle():
+            await update.message.reply_text(ERROR_TEXT)
+
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    # Connection problems and timeouts are usually transient, so one line is enough;
+    # BadRequest subclasses NetworkError but is a permanent failure worth a traceback
+    if isinstance(context.error, NetworkError) and not isinstance(context.error, BadRequest):
+        logger.warning(f"Network error: {context.error}")
+        return
+    logger.error("Unhandled error", exc_info=context.error)
+    if isinstance(update, Update) and logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Update: {update.to_dict()}")
+
+async def shutdown(application: Application):
+    for batcher in completion_batchers.values():
+        batcher.close()
+    if _openai_client is not None:
+        await _openai_client.close()
 
 def main():
-    updater = Updater(BOT_TOKEN, use_context=True)
-    dp = updater.dispatcher
+    # Bounded concurrent_updates lets other chats be served while one awaits OpenAI;
+    # the rate limiter keeps sends under Telegram's 30/s global and 20/min group limits;
+    # HTTP/2 multiplexes replies and edits over one kept-alive Bot API connection
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .http_version("2")
+        .concurrent_updates(BOT_WORKERS)
+        .rate_limiter(AIORateLimiter())
+        .post_shutdown(shutdown)
+        .build()
+    )
+
+    application.add_handler(CommandHandler("start", start))
+    # Restrict chat replies to the configured group so other chats never reach the handler
+    chat_filter = filters.TEXT & ~filters.COMMAND
+    if GROUP_CHAT_ID:
+        chat_filter = filters.Chat(chat_id=int(GROUP_CHAT_ID)) & chat_filter
+    application.add_handler(MessageHandler(chat_filter, chat))
+    application.add_error_handler(error_handler)
 
-    dp.add_handler(CommandHandler("start", start))
-    dp.add_handler(MessageHandler(Filters.text & ~Filters.command, chat))
+    # Every task on this loop runs eagerly: PTB's update fetcher, polling/webhook loops and
+    # per-update handler tasks all start inline, and steps that finish without awaiting
+    # skip the scheduler. Needs Python 3.12+; older versions keep the default factory.
+    loop = asyncio.new_event_loop()
+    if hasattr(asyncio, 'eager_task_factory'):
+        loop.set_task_factory(asyncio.eager_task_factory)
+    asyncio.set_event_loop(loop)
 
-    updater.start_polling()
-    updater.idle()
+    if PUBLIC_URL:
+        # Telegram pushes updates to us, so there is no poll round trip at all
+        application.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=BOT_TOKEN,
+            secret_token=WEBHOOK_SECRET,
+            webhook_url=f"{PUBLIC_URL.rstrip('/')}/{BOT_TOKEN}",
+            allowed_updates=[Update.MESSAGE],
+            drop_pending_updates=True
+        )
+    else:
+        # Long-poll so Telegram holds getUpdates open until a message arrives
+        application.run_polling(poll_interval=0.0, timeout=20, allowed_updates=[Update.MESSAGE],
+                                drop_pending_updates=True)
 
 if __name__ == '__main__':
     main()